@@ -2,4 +2,4 @@
 # Copyright (c) 2021 Mikołaj Kuranowski
 # SPDX-License-Identifier: MIT
 echo 'import { PolRegioGTFS } from "./src/parser.ts"; await PolRegioGTFS.main();' |
-deno run --unstable --allow-net --allow-read=gtfs --allow-write=gtfs --allow-run=zip -
+deno run --unstable --allow-net --allow-read=gtfs,.cache --allow-write=gtfs,.cache --allow-run=zip -
@@ -4,7 +4,9 @@
  * SPDX-License-Identifier: MIT
  */
 
-import { SECOND } from "https://deno.land/std@0.100.0/datetime/mod.ts";
+import { delay } from "https://deno.land/std@0.100.0/async/mod.ts";
+import { SECOND, WEEK } from "https://deno.land/std@0.100.0/datetime/mod.ts";
+import * as color from "https://deno.land/std@0.100.0/fmt/colors.ts";
 import * as xml from "https://deno.land/x/xmlp@v0.2.8/mod.ts";
 
 // --- SCHEDULES JSON API --- //
@@ -126,27 +128,225 @@ export class ResponseNotOK extends Error {
     }
 }
 
+/** Checks if a request which failed with the provided HTTP status should be retried */
+const isRetryable = (status: number) => status === 429 || status >= 500;
+
+/**
+ * Headers sent with every API request.
+ * Compression is negotiated by Deno's fetch, which also keeps connections alive on its own.
+ */
+const API_HEADERS: HeadersInit = { "Accept": "application/json" };
+
+/** Upper bound for the interval between requests after the API asked to slow down */
+const MAX_INTERVAL = 5 * SECOND;
+
+/**
+ * Parses the value of a Retry-After header
+ * @returns how long to wait (milliseconds), or undefined if the header is missing or invalid
+ */
+function parseRetryAfter(header: string | null): number | undefined {
+    if (header === null) return undefined;
+
+    const seconds = Number(header);
+    if (header.trim() !== "" && !Number.isNaN(seconds)) return seconds * SECOND;
+
+    const date = Date.parse(header);
+    return Number.isNaN(date) ? undefined : Math.max(0, date - Date.now());
+}
+
 /**
  * Endpoint is a class responsible for communicating with PolRegio API.
+ *
+ * Multiple calls may be in flight at once (up to `concurrency`). Requests are throttled
+ * with a token bucket: up to `burst` requests may be made at once, but on average
+ * requests are at least `pause` milliseconds apart. If the API responds with HTTP 429
+ * the interval is increased (and any Retry-After is honored), and then slowly brought
+ * back to `pause` as requests succeed.
  */
 export class Endpoint {
-    /** How long should we wait between API calls (milliseconds) */
+    /** How long should we wait between API calls, on average (milliseconds) */
     readonly pause: number;
 
+    /** How many requests can be made at once, without waiting for `pause` */
+    readonly burst = 4;
+
     /** The base URL for the API */
     readonly base: URL;
 
-    /** The timestamp when the previous call was made */
-    private lastCall = 0;
+    /** Pre-resolved base URL of the trains/{id} endpoint, see `trainData` */
+    private readonly trainsBase: string;
+
+    /** How many calls can be in flight at once */
+    readonly concurrency: number;
+
+    /** How many times a call failing with HTTP 429 or 5xx should be retried */
+    readonly retries: number;
+
+    /** Current interval between requests - `pause`, unless the API asked us to slow down */
+    private interval: number;
+
+    /**
+     * State of the token bucket - the timestamp when the next request would be made
+     * if no bursts were allowed. The bucket is full if this is in the past.
+     */
+    private nextCall = 0;
+
+    /** Timestamp of the last `slowDown` which increased the interval */
+    private lastSlowDown = 0;
+
+    /** How many calls are currently in flight */
+    private inFlight = 0;
+
+    /** Calls waiting for a free slot, see `acquire` */
+    private waiting: (() => void)[] = [];
+
+    /** Makes pending and future calls fail once aborted, see `abort` */
+    private aborter = new AbortController();
+
+    /** Responses of endpoints which don't change during a run (URL → data) */
+    private cache: Map<string, Promise<unknown>> = new Map();
+
+    /**
+     * Directory where responses of `trainData` are cached between runs.
+     * Train versions don't change once they're assigned an ID,
+     * so cached data is used for up to `cacheTTL`. Caching is disabled if unset.
+     */
+    cacheDir?: string;
+
+    /** For how long cached train data can be used (milliseconds) */
+    readonly cacheTTL = WEEK;
+
+    /** Resolves once `cacheDir` has been created */
+    private cacheDirCreated?: Promise<void>;
 
     /**
      * Creates a new Endpoint.
-     * @param pause minimal time between API calls (milliseconds)
+     * @param pause time between API calls, on average (milliseconds); see `burst`
      * @param base base URL of the API
+     * @param concurrency maximum number of API calls in flight
+     * @param retries how many times a call should be retried on HTTP 429 or 5xx
      */
-    constructor(pause?: number, base?: string) {
+    constructor(pause?: number, base?: string, concurrency?: number, retries?: number) {
         this.pause = pause ?? SECOND * (1 / 15);
+        this.interval = this.pause;
         this.base = new URL(base ?? "https://bilety.polregio.pl/pl/");
+        this.trainsBase = new URL("trains/", this.base).href;
+        this.concurrency = concurrency ?? 8;
+        this.retries = retries ?? 3;
+    }
+
+    /**
+     * Makes all pending and future calls fail with an AbortError,
+     * used to stop background requests once their results are no longer needed.
+     */
+    abort(): void {
+        this.aborter.abort();
+    }
+
+    /** Throws an AbortError if `abort` was called */
+    private throwIfAborted(): void {
+        if (this.aborter.signal.aborted) {
+            throw new DOMException("Endpoint was aborted", "AbortError");
+        }
+    }
+
+    /** Waits until less than `concurrency` calls are in flight and takes a slot */
+    private async acquire(): Promise<void> {
+        if (this.inFlight < this.concurrency) {
+            ++this.inFlight;
+        } else {
+            // The slot is handed over directly by `release`
+            await new Promise<void>((r) => this.waiting.push(r));
+        }
+    }
+
+    /** Frees a slot taken by `acquire` */
+    private release(): void {
+        const next = this.waiting.shift();
+        if (next !== undefined) next();
+        else --this.inFlight;
+    }
+
+    /**
+     * Waits until a token is available in the bucket, and takes it.
+     * The token is taken synchronously, so concurrent callers are spaced out.
+     */
+    private async waitForTurn(): Promise<void> {
+        const now = Date.now();
+        const next = Math.max(now, this.nextCall);
+        const at = Math.max(now, next - (this.burst - 1) * this.interval);
+        this.nextCall = next + this.interval;
+        if (at > now) await delay(at - now);
+    }
+
+    /**
+     * Reacts to a HTTP 429 response - doubles the interval between requests and empties
+     * the bucket, so that no requests are made before the provided time elapses.
+     *
+     * Concurrent requests are usually throttled together - the interval is only doubled
+     * once per such event, that is if the request was sent after the last slow down.
+     * @param wait how long to wait before the next request (milliseconds)
+     * @param sentAt when the throttled request was sent
+     */
+    private slowDown(wait: number, sentAt: number): void {
+        if (sentAt >= this.lastSlowDown) {
+            this.interval = Math.min(this.interval * 2, MAX_INTERVAL);
+            this.lastSlowDown = Date.now();
+        }
+
+        this.nextCall = Math.max(
+            this.nextCall,
+            Date.now() + wait + (this.burst - 1) * this.interval,
+        );
+    }
+
+    /** Brings the interval between requests back towards `pause` after a success */
+    private speedUp(): void {
+        if (this.interval > this.pause) {
+            this.interval = Math.max(this.pause, this.interval * 0.95);
+        }
+    }
+
+    /**
+     * Makes a request, retrying on HTTP 429 or 5xx.
+     * Throttling responses slow down all requests made by this Endpoint,
+     * server errors are retried with exponential backoff.
+     * @param where URL to request
+     * @returns the successful response
+     */
+    private async fetchWithRetries(where: URL): Promise<Response> {
+        for (let attempt = 0;; ++attempt) {
+            await this.waitForTurn();
+            this.throwIfAborted();
+
+            const sentAt = Date.now();
+            const response = await fetch(where, {
+                headers: API_HEADERS,
+                signal: this.aborter.signal,
+            });
+            if (response.ok) {
+                this.speedUp();
+                return response;
+            }
+
+            // Discard the body of failed responses,
+            // otherwise the underlying connection can't be reused
+            await response.body?.cancel();
+
+            const backoff = SECOND * 2 ** attempt;
+            if (response.status === 429) {
+                const retryAfter = parseRetryAfter(response.headers.get("Retry-After"));
+                this.slowDown(retryAfter ?? backoff, sentAt);
+            }
+
+            if (attempt >= this.retries || !isRetryable(response.status)) {
+                throw new ResponseNotOK(response);
+            }
+
+            // Throttled requests wait in `waitForTurn`
+            if (response.status !== 429) await delay(backoff);
+            this.throwIfAborted();
+        }
     }
 
     /**
@@ -156,36 +356,98 @@ export class Endpoint {
      * @returns the JSON data
      */
     private async call(where: URL, accessors?: string[]): Promise<unknown> {
-        // Timeout
-        const now: number = Date.now();
-        const delta = now - this.lastCall;
-        if (delta < this.pause) {
-            await new Promise((r) => setTimeout(r, this.pause - delta));
-        }
-        this.lastCall = now;
+        await this.acquire();
+        try {
+            this.throwIfAborted();
 
-        // Make the request
-        const response = await fetch(where);
+            // Make the request and parse the response
+            let data = await (await this.fetchWithRetries(where)).json();
 
-        // Verify success
-        if (!response.ok) throw new ResponseNotOK(response);
+            // Get accessors
+            for (const accessor of accessors ?? []) {
+                data = data[accessor];
+            }
 
-        // Parse response
-        let data = await response.json();
+            return data;
+        } finally {
+            this.release();
+        }
+    }
 
-        // Get accessors
-        for (const accessor of accessors ?? []) {
-            data = data[accessor];
+    /**
+     * Same as `call`, but the data is only requested once per URL.
+     * Concurrent calls share the same request; failed requests are not cached.
+     */
+    private cachedCall(where: URL, accessors?: string[]): Promise<unknown> {
+        const key = where.href;
+        let data = this.cache.get(key);
+
+        if (data === undefined) {
+            data = this.call(where, accessors);
+            data.catch(() => this.cache.delete(key));
+            this.cache.set(key, data);
         }
 
         return data;
     }
 
+    /**
+     * Reads data saved in `cacheDir` by `writeCache`
+     * @param path path to the cached file
+     * The cache is only an optimization - unreadable files are reported as warnings,
+     * and invalid files are removed.
+     * @returns cached data, or undefined if the file is missing, expired, unreadable or invalid
+     */
+    private async readCache(path: string): Promise<unknown> {
+        try {
+            const info = await Deno.stat(path);
+            if (info.mtime === null || Date.now() - info.mtime.getTime() > this.cacheTTL) {
+                return undefined;
+            }
+
+            return JSON.parse(await Deno.readTextFile(path));
+        } catch (e) {
+            if (e instanceof Deno.errors.NotFound) return undefined;
+
+            console.warn(color.yellow(`Unable to read cached ${path}: ${e}`));
+            if (e instanceof SyntaxError) await Deno.remove(path).catch(() => {});
+            return undefined;
+        }
+    }
+
+    /**
+     * Saves data to `cacheDir`, creating the directory if necessary.
+     * The data is written to a temporary file first, which is then renamed,
+     * so that `readCache` never sees a partially written file.
+     * The cache is only an optimization - failures are reported as warnings, not thrown.
+     * @param path path to the cached file
+     * @param data JSON data to save
+     */
+    private async writeCache(path: string, data: unknown): Promise<void> {
+        let tempPath: string | undefined;
+
+        try {
+            // Try to create the directory again on the next write if it failed
+            this.cacheDirCreated ??= Deno.mkdir(this.cacheDir!, { recursive: true }).catch((e) => {
+                this.cacheDirCreated = undefined;
+                throw e;
+            });
+            await this.cacheDirCreated;
+
+            tempPath = await Deno.makeTempFile({ dir: this.cacheDir, suffix: ".tmp" });
+            await Deno.writeTextFile(tempPath, JSON.stringify(data));
+            await Deno.rename(tempPath, path);
+        } catch (e) {
+            console.warn(color.yellow(`Unable to cache ${path}: ${e}`));
+            if (tempPath !== undefined) await Deno.remove(tempPath).catch(() => {});
+        }
+    }
+
     /**
      * Fetches and returns all Carriers in the API
      */
     async carriers(): Promise<Carrier[]> {
-        return await this.call(new URL("carriers", this.base), [
+        return await this.cachedCall(new URL("carriers", this.base), [
             "carriers",
         ]) as Carrier[];
     }
@@ -194,14 +456,14 @@ export class Endpoint {
      * Fetches and returns all Brands in the API
      */
     async brands(): Promise<Brand[]> {
-        return await this.call(new URL("brands", this.base), ["brands"]) as Brand[];
+        return await this.cachedCall(new URL("brands", this.base), ["brands"]) as Brand[];
     }
 
     /**
      * Fetches and returns all Stations in the API
      */
     async stations(): Promise<Station[]> {
-        return await this.call(new URL("stations", this.base), [
+        return await this.cachedCall(new URL("stations", this.base), [
             "stations",
         ]) as Station[];
     }
@@ -239,7 +501,7 @@ export class Endpoint {
     async trains(carrierSlug: string): Promise<CarrierTrainsList[]> {
         const url = new URL("carrier_trains_lists", this.base);
         url.searchParams.set("carrier", carrierSlug);
-        return await this.call(url, [
+        return await this.cachedCall(url, [
             "carrier_trains_lists",
         ]) as CarrierTrainsList[];
     }
@@ -258,12 +520,36 @@ export class Endpoint {
     }
 
     /**
-     * Fetches and returns metadata and all stations of a particular train version
+     * Fetches and returns metadata and all stations of a particular train version.
+     * If `cacheDir` is set, the data is read from and saved to the cache.
      * @param train_id id of the train version
      */
     async trainData(trainID: number): Promise<Train> {
-        const url = new URL(trainID.toString(), new URL("trains/", this.base));
-        return await this.call(url) as Train;
+        this.throwIfAborted();
+
+        const cachePath = this.cacheDir === undefined
+            ? undefined
+            : `${this.cacheDir}/train_${trainID}.json`;
+
+        if (cachePath !== undefined) {
+            const cached = await this.readCache(cachePath);
+            if (cached !== undefined) return cached as Train;
+        }
+
+        // Called for every train version - avoid resolving relative URLs every time
+        const data = await this.call(new URL(this.trainsBase + trainID));
+
+        if (cachePath !== undefined) await this.writeCache(cachePath, data);
+        return data as Train;
+    }
+
+    /**
+     * Concurrently fetches metadata and all stations of multiple train versions
+     * @param trainIDs ids of the train versions
+     * @returns train data, in the same order as provided IDs
+     */
+    async trainDataMany(trainIDs: Iterable<number>): Promise<Train[]> {
+        return await Promise.all(Array.from(trainIDs, (id) => this.trainData(id)));
     }
 }
 
@@ -277,6 +563,9 @@ export interface StationWithLocation {
     name: string;
 }
 
+/** Names of OSM elements which can have tags */
+const OSM_ELEMENTS = new Set(["node", "way", "relation"]);
+
 export async function getStationsWithLocation(
     url = "https://raw.githubusercontent.com/MKuranowski/PLRailMap/master/plrailmap.osm",
 ): Promise<[StationWithLocation[], Map<number, number>]> {
@@ -288,12 +577,14 @@ export async function getStationsWithLocation(
     const stations: StationWithLocation[] = [];
     const idChanges: Map<number, number> = new Map();
     const tags: Map<string, string> = new Map();
+    let inNode = false;
 
     // Handlers for parser events
     parser.on("start_element", (e) => {
         // When a new OSM element in encountered - clear the tags
         // as new ones will be loaded
-        if (["node", "way", "relation"].indexOf(e.localPart) >= 0) {
+        if (OSM_ELEMENTS.has(e.localPart)) {
+            inNode = e.localPart === "node";
             tags.clear();
         }
     }).on("end_element", (e) => {
@@ -302,6 +593,9 @@ export async function getStationsWithLocation(
         if (e.localPart === "tag") {
             // If a <tag> element was encountered -
             // save it to the `tags` map.
+            // Only nodes can be stations, so tags of ways and relations are skipped.
+            if (!inNode) return;
+
             let k: string | undefined;
             let v: string | undefined;
             for (const attr of e.attributes) {
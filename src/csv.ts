@@ -44,10 +44,24 @@ export class CSVFile {
         );
     }
 
+    /** Writes the whole buffer to the file, as `write` might do a partial write */
+    private async writeAll(view: Uint8Array): Promise<void> {
+        let written = 0;
+        while (written < view.length) {
+            written += await this.handle.write(view.subarray(written));
+        }
+    }
+
     /** Write a single row to the file */
     async write_row(row: Stringable[]): Promise<void> {
-        const view = this.encoder.encode(toCSV(row));
-        await this.handle.write(view);
+        await this.writeAll(this.encoder.encode(toCSV(row)));
+    }
+
+    /** Write multiple rows to the file, with a single write call */
+    async write_rows(rows: Iterable<Stringable[]>): Promise<void> {
+        let content = "";
+        for (const row of rows) content += toCSV(row);
+        await this.writeAll(this.encoder.encode(content));
     }
 
     /** Close the underlying file */
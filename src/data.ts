@@ -30,6 +30,9 @@ export const ATTRS = {
     REPLACEMENT_BUS: 100,
 };
 
+/** Attributes marking a section of a train as operated by a bus */
+export const BUS_ATTRS: Set<number> = new Set([ATTRS.BUS, ATTRS.REPLACEMENT_BUS]);
+
 export const ROUTES: Map<number, Route> = new Map([
     [3, { code: "REG", name: "Regio" }],
     [4, { code: "IR", name: "interRegio" }],
@@ -5,16 +5,35 @@
  */
 
 import { Endpoint, getStationsWithLocation, StationWithLocation } from "./api.ts";
-import type { CarrierTrain, Station, Time, TrainAttribute, TrainStop } from "./api.ts";
+import type { CarrierTrain, Station, Time, Train, TrainAttribute, TrainStop } from "./api.ts";
 import { CSVFile } from "./csv.ts";
 import * as data from "./data.ts";
-import * as datetime from "https://deno.land/std@0.100.0/datetime/mod.ts";
+import { DateTimeFormatter } from "https://deno.land/std@0.100.0/datetime/formatter.ts";
 import * as color from "https://deno.land/std@0.100.0/fmt/colors.ts";
 import { emptyDir } from "https://deno.land/std@0.100.0/fs/mod.ts";
 
 // TrainLeg is a type used internally for representing TrainLegs with assigned attributes
 type TrainLeg = { attrs: Set<number>; stops: TrainStop[] };
 
+// Row is a type used internally for representing a single row of a GTFS file
+type Row = (string | number)[];
+
+// FetchedTrain is a type used internally for representing a train with all its versions
+// (tripID -> dates of that version; and data of every version, in the same order)
+type FetchedTrain = { train: CarrierTrain; dates: Map<number, string[]>; versions: Train[] };
+
+/** How many trains should be fetched ahead of the train being written */
+const PREFETCH_TRAINS = 16;
+
+/** Minimal time between progress updates on the terminal (milliseconds) */
+const PROGRESS_INTERVAL = 100;
+
+/** Format of the update time returned by the carriers endpoint */
+const API_UPDATE_TIME = new DateTimeFormatter("HH:mm dd.MM.yyyy");
+
+/** Regular expression matching dates used by the API (yyyy-MM-dd) */
+const API_DATE = /^(\d{4})-(\d{2})-(\d{2})$/;
+
 /**
  * WithFile wraps an async function expecting a CSVFile to
  * automatically open and close CSVFile with a provided filename
@@ -35,11 +54,15 @@ function WithFile<T>(
 /** Converts an integer to a two-letter string representation */
 const toTwoDigits = (n: number) => n.toFixed(0).padStart(2, "0");
 
+/** Amount of seconds in a day */
+const DAY = 86400;
+
 /** Converts a Time object to an int - representing an amount of seconds */
 const timeToInt = (t: Time) => 3600 * t.hour + 60 * t.minute + t.second;
 
 /** Converts a Time object to a nice string representation */
-const timeToStr = (t: Time) => [t.hour, t.minute, t.second].map(toTwoDigits).join(":");
+const timeToStr = (t: Time) =>
+    `${toTwoDigits(t.hour)}:${toTwoDigits(t.minute)}:${toTwoDigits(t.second)}`;
 
 /** Checks if a TrainLeg is actually operated by a bus */
 const legIsBus = (l: TrainLeg) =>
@@ -47,6 +70,16 @@ const legIsBus = (l: TrainLeg) =>
     l.attrs.has(data.ATTRS.BUS) ||
     l.attrs.has(data.ATTRS.REPLACEMENT_BUS);
 
+/**
+ * Marks a promise running in the background as handled and returns it.
+ * Errors are still thrown where the promise is awaited, but a failure before that
+ * doesn't crash Deno with an unhandled rejection.
+ */
+function background<T>(promise: Promise<T>): Promise<T> {
+    promise.catch(() => {});
+    return promise;
+}
+
 /**
  * Implementation of Python's enumerate.
  * Yields elements from an iterable and their associated indexes.
@@ -58,15 +91,19 @@ function* enumerate<T>(iterable: Iterable<T>, start = 0): Generator<[number, T],
 }
 
 /**
- * Reverses APIs "date_train_map"
+ * Reverses APIs "date_train_map".
+ * Dates are only re-arranged into GTFS format (yyyyMMdd), without parsing them into Date objects.
  * @param o "date_train_map" object (mapping date -> tripID)
  * @returns mapping tripID -> date[]
  */
-function reverseDateTrainMap(o: Record<string, number>): Map<number, Date[]> {
-    const m: Map<number, Date[]> = new Map();
+function reverseDateTrainMap(o: Record<string, number>): Map<number, string[]> {
+    const m: Map<number, string[]> = new Map();
 
     for (const [dateStr, tripID] of Object.entries(o)) {
-        const date = datetime.parse(dateStr, "yyyy-MM-dd");
+        const match = API_DATE.exec(dateStr);
+        if (match === null) throw `Invalid date in the API's date_train_map: ${dateStr}`;
+
+        const date = match[1] + match[2] + match[3];
         const arr = m.get(tripID);
         if (arr !== undefined) {
             arr.push(date);
@@ -82,25 +119,52 @@ function reverseDateTrainMap(o: Record<string, number>): Map<number, Date[]> {
  * Modifies the provided list of stations to avoid time travel
  */
 function fixTimes(stops: TrainStop[]): TrainStop[] {
-    let prevDep: Time = { hour: 0, minute: 0, second: 0 };
+    let prevDep = 0;
 
     for (const stop of stops) {
         // Correct arrival
-        while (timeToInt(stop.arrival) < timeToInt(prevDep)) {
-            stop.arrival.hour += 24;
+        let arr = timeToInt(stop.arrival);
+        if (arr < prevDep) {
+            const days = Math.ceil((prevDep - arr) / DAY);
+            stop.arrival.hour += 24 * days;
+            arr += DAY * days;
         }
 
         // Correct departure
-        while (timeToInt(stop.departure) < timeToInt(stop.arrival)) {
-            stop.departure.hour += 24;
+        let dep = timeToInt(stop.departure);
+        if (dep < arr) {
+            const days = Math.ceil((arr - dep) / DAY);
+            stop.departure.hour += 24 * days;
+            dep += DAY * days;
         }
 
-        prevDep = stop.departure;
+        prevDep = dep;
     }
 
     return stops;
 }
 
+/**
+ * Indexes positions of stations in a single pass
+ * @param stopNames names of consecutive stops of a train
+ * @returns mappings of station name to its first and last index;
+ *     names with different first and last indexes are ambiguous.
+ */
+function indexStopNames(
+    stopNames: string[],
+): { first: Map<string, number>; last: Map<string, number> } {
+    const first: Map<string, number> = new Map();
+    const last: Map<string, number> = new Map();
+
+    for (let idx = 0; idx < stopNames.length; ++idx) {
+        const name = stopNames[idx];
+        if (!first.has(name)) first.set(name, idx);
+        last.set(name, idx);
+    }
+
+    return { first, last };
+}
+
 /**
  * Tries to detect at which indexes the train should be split into separate legs
  */
@@ -111,16 +175,18 @@ function getBreakLegsAt(
 ): Set<number> {
     const s: Set<number> = new Set();
     const lastIDX = stopNames.length - 1;
+    let index: ReturnType<typeof indexStopNames> | undefined;
 
     for (const attr of attrs) {
         // Only busses can force a leg break
-        if (attr[0] !== data.ATTRS.BUS && attr[0] !== data.ATTRS.REPLACEMENT_BUS) {
-            continue;
-        }
+        if (!data.BUS_ATTRS.has(attr[0])) continue;
+
+        // Stop names only need to be indexed if there are any bus attributes
+        index ??= indexStopNames(stopNames);
 
         // Check start of bus section
-        let idx = stopNames.indexOf(attr[2]);
-        if (idx !== stopNames.lastIndexOf(attr[2])) {
+        let idx = index.first.get(attr[2]) ?? -1;
+        if (idx !== (index.last.get(attr[2]) ?? -1)) {
             console.warn(color.yellow(
                 "Train " +
                     color.cyan(tripID.toString()) +
@@ -129,11 +195,11 @@ function getBreakLegsAt(
             ));
         }
 
-        if (idx !== 0 && idx !== lastIDX) s.add(idx);
+        if (idx > 0 && idx < lastIDX) s.add(idx);
 
         // Check end of bus section
-        idx = stopNames.lastIndexOf(attr[3]);
-        if (idx !== stopNames.indexOf(attr[3])) {
+        idx = index.last.get(attr[3]) ?? -1;
+        if (idx !== (index.first.get(attr[3]) ?? -1)) {
             console.warn(color.yellow(
                 "Train " +
                     color.cyan(tripID.toString()) +
@@ -142,7 +208,7 @@ function getBreakLegsAt(
             ));
         }
 
-        if (idx !== 0 && idx !== lastIDX) s.add(idx);
+        if (idx > 0 && idx < lastIDX) s.add(idx);
     }
 
     return s;
@@ -153,35 +219,41 @@ function getBreakLegsAt(
  * may be completed by a bus, some by a train.
  */
 function splitLegs(tripID: number, stops: TrainStop[], attrs: TrainAttribute[]): TrainStop[][] {
+    // Only busses can force a leg break - and most trains don't have any bus attributes
+    if (!attrs.some((attr) => data.BUS_ATTRS.has(attr[0]))) {
+        return stops.length > 1 ? [stops] : [];
+    }
+
     const legs: TrainStop[][] = [];
-    let legSoFar: TrainStop[] = [];
-    const breakAt = getBreakLegsAt(
+    const breakAt = Array.from(getBreakLegsAt(
         tripID,
         attrs,
         stops.map((s) => s.station_name),
-    );
-
-    for (const [idx, stop] of enumerate(stops)) {
-        if (breakAt.has(idx)) {
-            // Finish the current leg by appending this
-            // stop without the departure_time
-            const stopArrOnly: TrainStop = { ...stop };
-            stopArrOnly.departure = stopArrOnly.arrival;
-            stopArrOnly.platform = "";
-            legSoFar.push(stopArrOnly);
-            legs.push(legSoFar);
-
-            // Start the next leg with
-            // this stop without the arrival
-            const stopDepOnly: TrainStop = { ...stop };
-            stopDepOnly.arrival = stopDepOnly.departure;
-            legSoFar = [stopDepOnly];
-        } else {
-            legSoFar.push(stop);
-        }
+    )).sort((a, b) => a - b);
+
+    // Instead of walking over every stop, the stops are sliced at the breaks
+    let legStart = 0;
+    let legFirstStop = stops[0];
+
+    for (const idx of breakAt) {
+        const stop = stops[idx];
+
+        // Finish the current leg by appending this
+        // stop without the departure_time
+        const leg = stops.slice(legStart, idx);
+        leg[0] = legFirstStop;
+        leg.push({ ...stop, departure: stop.arrival, platform: "" });
+        legs.push(leg);
+
+        // Start the next leg with
+        // this stop without the arrival
+        legStart = idx;
+        legFirstStop = { ...stop, arrival: stop.departure };
     }
 
-    if (legSoFar.length > 1) legs.push(legSoFar);
+    const lastLeg = stops.slice(legStart);
+    lastLeg[0] = legFirstStop;
+    if (lastLeg.length > 1) legs.push(lastLeg);
     return legs;
 }
 
@@ -235,7 +307,7 @@ export class PolRegioGTFS {
     knownCarriers: Map<number, string> = new Map();
 
     /** IDs of all used stations (id -> Station) */
-    usedStations: Map<string, Station> = new Map();
+    usedStations: Map<number, Station> = new Map();
 
     /** Brand IDs for which a bus routes needs to be generated */
     brandsWithBusses: Set<number> = new Set();
@@ -249,12 +321,24 @@ export class PolRegioGTFS {
     /** Map to change station IDs on the fly */
     stationIDChanges: Map<number, number> = new Map();
 
+    /** Resolves once `stations` and `stationIDChanges` are loaded, see `parseAll` */
+    private stationsLoaded: Promise<void> = Promise.resolve();
+
+    /** Timestamp of the last progress update, see `logProgress` */
+    private lastProgress = 0;
+
     // CSVFile handles for some of the files used by the Parser
     trips?: CSVFile;
     times?: CSVFile;
     dates?: CSVFile;
     transfers?: CSVFile;
 
+    // Rows waiting to be written to the above files, see `flushRows`
+    private tripsRows: Row[] = [];
+    private timesRows: Row[] = [];
+    private datesRows: Row[] = [];
+    private transfersRows: Row[] = [];
+
     /**
      * Prepares attached file handles, needs to be called prior
      * to starting all of the parsing.
@@ -361,9 +445,8 @@ export class PolRegioGTFS {
             this.knownCarriers.set(agency.id, agency.slug);
 
             // Update Time
-            const updateTime = datetime.parse(
+            const updateTime = API_UPDATE_TIME.parse(
                 `${agency.update_time} ${agency.update_date}`,
-                "HH:mm dd.MM.yyyy",
             );
             if (updateTime > this.updateTime) this.updateTime = updateTime;
         }
@@ -441,16 +524,24 @@ export class PolRegioGTFS {
     parseRoutes = WithFile(this.parseRoutesInto.bind(this), "gtfs/routes.txt");
 
     /**
-     * Parses and writes all versions of a particular train
-     * trips.txt, stop_times.txt, calendar_dates.txt and transfers.txt will be modified.
+     * Overwrites the last two lines of the terminal with the currently parsed train and its
+     * version. Writing to the terminal is slow, so this is done at most every PROGRESS_INTERVAL.
      */
-    async parseTrain(train: CarrierTrain): Promise<void> {
+    private logProgress(train: CarrierTrain, tripID: number): void {
+        const now = Date.now();
+        if (now - this.lastProgress < PROGRESS_INTERVAL) return;
+        this.lastProgress = now;
+
         console.log(
-            `\x1B[2A\x1B[KParsing trains: ${train.brand} ${train.nr} '${
-                train.name ??
-                    ""
-            }'\n`,
+            `\x1B[2A\x1B[KParsing trains: ${train.brand} ${train.nr} '${train.name ?? ""}'\n` +
+                `\x1B[KParsing train version: ${tripID}`,
         );
+    }
+
+    /**
+     * Fetches the calendar and all versions of a particular train
+     */
+    async fetchTrain(train: CarrierTrain): Promise<FetchedTrain> {
         const data = await this.api.trainCalendars(train);
 
         // Ensure only one calendar exists
@@ -462,30 +553,72 @@ export class PolRegioGTFS {
         }
 
         const calendar = data[0];
-        const dateMap = reverseDateTrainMap(calendar.date_train_map);
+        const dates = reverseDateTrainMap(calendar.date_train_map);
+
+        // Fetch all versions of the train at once
+        const versions = await this.api.trainDataMany(dates.keys());
+        return { train, dates, versions };
+    }
+
+    /**
+     * Writes all versions of a train, as returned by `fetchTrain`.
+     * trips.txt, stop_times.txt, calendar_dates.txt and transfers.txt will be modified.
+     */
+    async writeTrain({ train, dates, versions }: FetchedTrain): Promise<void> {
+        await this.stationsLoaded;
 
-        for (const [tripID, dates] of dateMap.entries()) {
-            const ok = await this.parseTrip(tripID);
+        for (const [idx, [tripID, tripDates]] of enumerate(dates)) {
+            this.logProgress(train, tripID);
+            const ok = this.parseTrip(tripID, versions[idx]);
             if (!ok) continue;
 
-            for (const date of dates) {
-                await this.dates?.write_row([
-                    tripID,
-                    datetime.format(date, "yyyyMMdd"),
-                    "1",
-                ]);
+            for (const date of tripDates) {
+                this.datesRows.push([tripID, date, "1"]);
             }
         }
+
+        // All rows of all versions are written at once
+        await this.flushRows();
     }
 
     /**
-     * Parses and writes a particular version of a train.
-     * trips.txt, stop_times.txt and transfers.txt will be modified.
+     * Writes rows buffered by `parseTrip` and `writeTrain` to
+     * trips.txt, stop_times.txt, calendar_dates.txt and transfers.txt.
      */
-    async parseTrip(tripID: number): Promise<boolean> {
-        console.log(`\x1B[1A\x1B[KParsing train version: ${tripID}`);
-        const data = await this.api.trainData(tripID);
+    private async flushRows(): Promise<void> {
+        const [trips, times, dates, transfers] = [
+            this.tripsRows,
+            this.timesRows,
+            this.datesRows,
+            this.transfersRows,
+        ];
+        this.tripsRows = [];
+        this.timesRows = [];
+        this.datesRows = [];
+        this.transfersRows = [];
 
+        await Promise.all([
+            this.trips?.write_rows(trips),
+            this.times?.write_rows(times),
+            this.dates?.write_rows(dates),
+            this.transfers?.write_rows(transfers),
+        ]);
+    }
+
+    /**
+     * Parses and writes all versions of a particular train
+     * trips.txt, stop_times.txt, calendar_dates.txt and transfers.txt will be modified.
+     */
+    async parseTrain(train: CarrierTrain): Promise<void> {
+        await this.writeTrain(await this.fetchTrain(train));
+    }
+
+    /**
+     * Parses a particular version of a train, as returned by the API's trainData endpoint.
+     * Rows for trips.txt, stop_times.txt and transfers.txt are buffered,
+     * and need to be written with `flushRows`.
+     */
+    parseTrip(tripID: number, data: Train): boolean {
         // Ensure this train has stops
         if (data.stops.length === 0) {
             console.warn(color.yellow(
@@ -503,7 +636,7 @@ export class PolRegioGTFS {
             legStops,
         );
 
-        const gtfsTrip: (string | number)[] = [
+        const gtfsTrip: Row = [
             data.train.brand_id,
             tripID,
             tripID,
@@ -514,9 +647,9 @@ export class PolRegioGTFS {
         ];
 
         if (legs.length > 1) {
-            await this.writeMultipleLegs(gtfsTrip, legs);
+            this.writeMultipleLegs(gtfsTrip, legs);
         } else if (legs.length === 1) {
-            await this.writeSingleLeg(gtfsTrip, legs[0]);
+            this.writeSingleLeg(gtfsTrip, legs[0]);
         } else {
             throw `Train ${tripID} has no legs`;
         }
@@ -525,14 +658,11 @@ export class PolRegioGTFS {
     }
 
     /**
-     * Writes a single leg to stop_times.txt.
+     * Buffers rows of a single leg for trips.txt and stop_times.txt.
      * Also checks (and modifies) route_id column if this leg is operated by a bus
      * Might update `brandsWithBusses`.
      */
-    private async writeSingleLeg(
-        gtfsTrip: (string | number)[],
-        leg: TrainLeg,
-    ): Promise<void> {
+    private writeSingleLeg(gtfsTrip: Row, leg: TrainLeg): void {
         // Check for replacement busses
         if (legIsBus(leg)) {
             this.brandsWithBusses.add(gtfsTrip[0] as number);
@@ -550,22 +680,30 @@ export class PolRegioGTFS {
         const distOffset = leg.stops[0].distance;
 
         // Write to trips.txt
-        await this.trips?.write_row(gtfsTrip);
+        this.tripsRows.push(gtfsTrip);
 
         // Write to stop_times.txt
-        for (const [seq, stop] of enumerate(leg.stops)) {
-            this.usedStations.set(
-                stop.station_id.toString(),
-                {
+        // (this runs for every stop, so all lookups outside of the stop are hoisted)
+        const tripID = gtfsTrip[2];
+        const stops = leg.stops;
+        const usedStations = this.usedStations;
+        const timesRows = this.timesRows;
+
+        for (let seq = 0; seq < stops.length; ++seq) {
+            const stop = stops[seq];
+
+            // Most stops are at already seen stations - only check for membership
+            if (!usedStations.has(stop.station_id)) {
+                usedStations.set(stop.station_id, {
                     id: stop.station_id,
                     ibnr: stop.station_ibnr,
                     name: stop.station_name,
                     name_slug: stop.station_slug,
-                },
-            );
+                });
+            }
 
-            await this.times?.write_row([
-                gtfsTrip[2],
+            timesRows.push([
+                tripID,
                 seq,
                 stop.station_id,
                 timeToStr(stop.arrival),
@@ -577,15 +715,12 @@ export class PolRegioGTFS {
     }
 
     /**
-     * Writes multiple legs to trips.txt, stop_times.txt and transfers.txt.
+     * Buffers rows of multiple legs for trips.txt, stop_times.txt and transfers.txt.
      * The baseGtfsTrip will be used as a template for all trips.txt rows
      * - trip_id will be modified with a suffix representing a leg,
      * - route_id might be modified if a leg is operated by a bus.
      */
-    private async writeMultipleLegs(
-        baseGtfsTrip: (string | number)[],
-        legs: TrainLeg[],
-    ) {
+    private writeMultipleLegs(baseGtfsTrip: Row, legs: TrainLeg[]): void {
         let previousLegID = "";
 
         for (const [suffix, leg] of enumerate(legs)) {
@@ -596,11 +731,11 @@ export class PolRegioGTFS {
             legGtfsTrip[2] = legID;
 
             // Write to trips.txt and stop_times.txt (and also handle bus legs)
-            await this.writeSingleLeg(legGtfsTrip, leg);
+            this.writeSingleLeg(legGtfsTrip, leg);
 
             // Write to transfers.txt
             if (previousLegID) {
-                await this.transfers?.write_row([
+                this.transfersRows.push([
                     leg.stops[0].station_id,
                     leg.stops[0].station_id,
                     previousLegID,
@@ -615,15 +750,40 @@ export class PolRegioGTFS {
 
     /**
      * Walks over every train of every known carrier (from `knownCarriers`) and
-     * calls parseTrain on it.
+     * parses it. Up to PREFETCH_TRAINS trains are fetched ahead of the one being written,
+     * so that writing overlaps with API calls. Trains are still written in order.
+     *
+     * If anything fails, the Endpoint is aborted - so that prefetched trains
+     * stop making API calls, as their results will never be used.
      */
     async parseAllTrains(): Promise<void> {
-        for (const [, agencySlug] of this.knownCarriers) {
-            for (const brand of await this.api.trains(agencySlug)) {
-                for (const train of brand.trains) {
-                    await this.parseTrain(train);
+        const pending: Promise<FetchedTrain>[] = [];
+
+        try {
+            // Request train lists of all carriers upfront, so that the next list
+            // is ready by the time trains of the previous carrier have been queued
+            const carrierTrains = Array.from(
+                this.knownCarriers.values(),
+                (slug) => background(this.api.trains(slug)),
+            );
+
+            for (const brands of carrierTrains) {
+                for (const brand of await brands) {
+                    for (const train of brand.trains) {
+                        pending.push(background(this.fetchTrain(train)));
+                        if (pending.length > PREFETCH_TRAINS) {
+                            await this.writeTrain(await pending.shift()!);
+                        }
+                    }
                 }
             }
+
+            for (const fetched of pending) {
+                await this.writeTrain(await fetched);
+            }
+        } catch (e) {
+            this.api.abort();
+            throw e;
         }
     }
 
@@ -632,6 +792,7 @@ export class PolRegioGTFS {
      * and saves **used** stops
      */
     private async parseStopsInto(f: CSVFile): Promise<void> {
+        await this.stationsLoaded;
         const unknownStations = new Map(this.usedStations);
         await f.write_row([
             "stop_id",
@@ -641,13 +802,20 @@ export class PolRegioGTFS {
             "stop_IBNR",
         ]);
 
+        const rows: string[][] = [];
         for (const s of this.stations) {
+            // Only refs which are exactly the API's numeric ID can match,
+            // so that stops.txt uses the same stop_id as stop_times.txt
+            const id = Number(s.id);
+            if (String(id) !== s.id) continue;
+
             // Try to remove this station from unknownStations
             // - if the removal failed - this station was not used
             // and can be ignored
-            if (!unknownStations.delete(s.id)) continue;
-            await f.write_row([s.id, s.name, s.lat, s.lon, s.ibnr]);
+            if (!unknownStations.delete(id)) continue;
+            rows.push([s.id, s.name, s.lat, s.lon, s.ibnr]);
         }
+        await f.write_rows(rows);
 
         if (unknownStations.size > 0) {
             console.log(color.red("Missing stations"));
@@ -668,8 +836,10 @@ export class PolRegioGTFS {
     parseStops = WithFile(this.parseStopsInto.bind(this), "gtfs/stops.txt");
 
     async parseAll(): Promise<void> {
+        // Station data is only needed once train versions are parsed,
+        // so it's loaded in the background, while the API is queried.
         console.log("Loading station data");
-        await this.loadStations();
+        this.stationsLoaded = background(this.loadStations());
 
         console.log("Parsing agencies");
         await this.parseAgencies();
@@ -699,6 +869,7 @@ export class PolRegioGTFS {
 
     static async main() {
         const parser = new PolRegioGTFS();
+        parser.api.cacheDir = ".cache/trains";
         await parser.open();
         await parser.parseAll().finally(parser.close.bind(this));
     }